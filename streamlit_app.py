@@ -1,19 +1,91 @@
 import streamlit as st
+import asyncio
+import hashlib
+import multiprocessing
 import os
-from operator import itemgetter
-
-# --- MODERN IMPORTS ---
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+import queue
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeout
 
 # --- CONSTANTS ---
 PDF_FILE_PATH = "WHOAMR.pdf"
 APP_TITLE = "PrescribeWise - Health Worker Assistant"
+EMBED_MODEL = "text-embedding-3-small"
+EMBED_DIMENSIONS = 512  # Matryoshka truncation: ~1/3 the scan bandwidth of 1536-d
+INDEX_CACHE_DIR = "rag_index"
+INDEX_SCHEMA_VERSION = 5  # bump when chunking or persisted metadata changes shape
+EMBED_BATCH_TOKEN_BUDGET = 250_000  # stay under the API's 300k input cap
+EMBED_BATCH_MAX_ITEMS = 2048  # hard API limit on inputs per request
+EMBED_CONCURRENCY = 8  # concurrent embedding requests; bounded for rate limits
+EMBED_MAX_RETRIES = 4
+CHUNK_TOKENS = 512
+CHUNK_TOKEN_OVERLAP = 64
+MIN_CHUNK_TOKENS = 96  # tail windows shorter than this merge into a full one
+EVIDENCE_PREVIEW_CHARS = 300  # length of the precomputed source snippet
+RETRIEVAL_K = 6
+MMR_FETCH_K = 20  # candidates pulled before MMR whittles them down to k
+MMR_LAMBDA = 0.5  # relevance vs. diversity trade-off in the MMR re-rank
+NUMPY_SEARCH_MAX = 8192  # corpora this small skip FAISS dispatch entirely
+# Build the HNSW graph only where queries will actually reach FAISS — the
+# resident-matrix BLAS path serves everything under NUMPY_SEARCH_MAX, so a
+# lower threshold would train a graph that never gets searched.
+HNSW_THRESHOLD = NUMPY_SEARCH_MAX
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+MAX_HISTORY_MESSAGES = 24  # ring-buffer cap on the rendered chat history
+QA_CACHE_MAX = 128  # per-session cap on cached (question, language) answers
+SIDEBAR_ICON_URL = "https://cdn-icons-png.flaticon.com/512/3063/3063176.png"
+
+# Static HTML resolved once at import time so the per-rerun layout code
+# only re-sends prebuilt strings.
+HEADER_HTML = """
+    <div class="header-container">
+        <div class="header-title">🩺 PrescribeWise</div>
+        <div class="header-subtitle">AI-Powered Assistant for WHO Antimicrobial Guidelines</div>
+    </div>
+"""
+
+DISCLAIMER_HTML = """
+    <div class="disclaimer-box">
+        <strong>⚠️ IMPORTANT MEDICAL DISCLAIMER</strong><br>
+        This AI tool assists healthcare professionals by retrieving information solely from the
+        <em>WHO AWaRe Antibiotic Book</em>. It does <strong>not</strong> replace professional medical judgment.
+        Always verify dosages and treatment protocols with local guidelines.
+    </div>
+"""
+
+# Pre-rendered HTML so each sidebar section ships as one element and skips
+# the client-side markdown parsing of several separate st.markdown calls.
+# Separators ride along as <hr> tags instead of dedicated st.divider()
+# elements, each of which costs its own websocket message and component.
+LANGUAGE_HEADING_HTML = """
+    <hr class="sidebar-sep">
+    <h3>🌐 Language / ቋንቋ</h3>
+"""
+
+LEGEND_HTML = """
+    <hr class="sidebar-sep">
+    <h3>🚦 AWaRe Color Legend</h3>
+    <p>
+        <strong><span style="color:#09ab3b">🟢 First Choice</span></strong><br>
+        <strong><span style="color:#ffa421">🟡 Second Choice</span></strong><br>
+        <strong><span style="color:#ff4b4b">🔴 Reserve</span></strong>
+    </p>
+    <hr class="sidebar-sep">
+"""
+
+FOOTER_HTML = """
+    <div class="footer">
+        PrescribeWise · Answers are derived solely from the <em>WHO AWaRe Antibiotic Book</em>.
+        Always verify against local guidelines.
+    </div>
+"""
 
 # --- 1. PAGE CONFIG ---
 st.set_page_config(
@@ -36,6 +108,17 @@ st.markdown("""
     }
     .header-title { font-size: 2.5rem; font-weight: 800; margin: 0; }
     .header-subtitle { font-size: 1.2rem; opacity: 0.9; margin-top: 5px; }
+    .footer {
+        text-align: center;
+        font-size: 0.8rem;
+        opacity: 0.6;
+        margin-top: 2rem;
+    }
+    .sidebar-sep {
+        margin: 0.75rem 0;
+        border: none;
+        border-top: 1px solid rgba(49,51,63,0.2);
+    }
     .disclaimer-box {
         background-color: #fff3cd;
         border-left: 6px solid #ffc107;
@@ -49,21 +132,48 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- 3. UI LAYOUT ---
-st.markdown(f"""
-    <div class="header-container">
-        <div class="header-title">🩺 PrescribeWise</div>
-        <div class="header-subtitle">AI-Powered Assistant for WHO Antimicrobial Guidelines</div>
-    </div>
-""", unsafe_allow_html=True)
+def create_header(header_html=HEADER_HTML, disclaimer_html=DISCLAIMER_HTML):
+    st.markdown(header_html, unsafe_allow_html=True)
+    st.markdown(disclaimer_html, unsafe_allow_html=True)
 
-st.markdown("""
-    <div class="disclaimer-box">
-        <strong>⚠️ IMPORTANT MEDICAL DISCLAIMER</strong><br>
-        This AI tool assists healthcare professionals by retrieving information solely from the 
-        <em>WHO AWaRe Antibiotic Book</em>. It does <strong>not</strong> replace professional medical judgment. 
-        Always verify dosages and treatment protocols with local guidelines.
-    </div>
-""", unsafe_allow_html=True)
+
+def create_sidebar(icon_url=SIDEBAR_ICON_URL):
+    with st.sidebar:
+        st.image(icon_url, width=50)
+        st.header("App Settings")
+
+        st.markdown(LANGUAGE_HEADING_HTML, unsafe_allow_html=True)
+        # Form-gated so picking a language fires a single rerun on Apply
+        # instead of one per widget interaction.
+        with st.form("language_settings", border=False):
+            language = st.selectbox(
+                "Choose response language:",
+                [
+                    "English",
+                    "Amharic (አማርኛ)",
+                    "Swahili (Kiswahili)",
+                    "Oromo (Afaan Oromoo)",
+                    "French (Français)",
+                    "Spanish (Español)",
+                    "Arabic (العربية)",
+                    "Portuguese (Português)"
+                ],
+                key="language_selector"
+            )
+            st.form_submit_button("✅ Apply Language", use_container_width=True)
+
+        st.markdown(LEGEND_HTML, unsafe_allow_html=True)
+
+        if st.button("🔄 Start New Consultation", type="primary", use_container_width=True):
+            st.session_state.messages = deque(maxlen=MAX_HISTORY_MESSAGES)
+            st.session_state.pop("last_response_id", None)
+            st.session_state.pop("chain_turns", None)
+            st.session_state.pop("qa_cache", None)
+            st.rerun()
+    return language
+
+
+create_header()
 
 # --- 4. CREDENTIALS ---
 if "OPENAI_API_KEY" in st.secrets:
@@ -76,83 +186,547 @@ if not os.path.exists(PDF_FILE_PATH):
     st.error(f"🚨 Guidelines file not found: `{PDF_FILE_PATH}`. Please upload it to your GitHub repository.")
     st.stop()
 
-# --- 5. LOAD KNOWLEDGE BASE ---
+# --- MODERN IMPORTS ---
+# Imported only after the credential/file checks above so the error path
+# doesn't pay for the heavy SDK import chain on cold start.
+# Searches arrive as batched query blocks (see _SearchBatcher), which
+# OpenMP can split across rows — but small containers thrash when OpenMP
+# grabs every core, so cap the team at four.
+FAISS_NUM_THREADS = min(4, os.cpu_count() or 1)
+os.environ.setdefault("OMP_NUM_THREADS", str(FAISS_NUM_THREADS))
+import faiss
+import httpx
+import numpy as np
+import orjson
+import tiktoken
+from openai import AsyncOpenAI, OpenAI, RateLimitError
+
+try:
+    # MuPDF's C extractor is typically 5-10x faster than pure-Python pypdf.
+    import fitz
+except ImportError:
+    fitz = None
+    from pypdf import PdfReader
+
+faiss.omp_set_num_threads(FAISS_NUM_THREADS)
+
+
 @st.cache_resource(show_spinner=False)
-def load_knowledge_base(key):
+def get_openai_client(key):
+    # Cached so reruns reuse the same httpx connection pool (and its warm
+    # TLS session to api.openai.com) instead of building a new client.
+    # HTTP/2 lets the chat stream and any concurrent embedding call
+    # multiplex over one connection instead of opening a second one.
+    return OpenAI(
+        api_key=key,
+        http_client=httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        ),
+    )
+
+
+client = get_openai_client(api_key)
+
+
+# --- 5. LOAD KNOWLEDGE BASE ---
+# Compiled once; _clean_text runs for every page of a 700-page PDF.
+_WS_RE = re.compile(r"[ \t]+")
+_NL_RE = re.compile(r"\n{3,}")
+_NUL_TRANS = str.maketrans({"\x00": " ", "\u00a0": " "})
+
+
+def _clean_text(text):
+    return _NL_RE.sub("\n\n", _WS_RE.sub(" ", text.translate(_NUL_TRANS))).strip()
+
+
+def _extract_one_page(page):
+    return _clean_text(page.extract_text() or "")
+
+
+def _read_pdf_pages(path):
+    if fitz is not None:
+        with fitz.open(path) as doc:
+            texts = [_clean_text(page.get_text("text")) for page in doc]
+    else:
+        # pypdf fallback: pages are independent, so extraction fans out
+        # across a thread pool; ex.map keeps results in page order.
+        reader = PdfReader(path)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            texts = list(ex.map(_extract_one_page, reader.pages))
+    return [{"page": number, "text": text}
+            for number, text in enumerate(texts, start=1) if text]
+
+
+def _pdf_digest():
+    digest = hashlib.sha256()
+    with open(PDF_FILE_PATH, "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _read_pdf_pages_cached(path):
+    # Keyed on the PDF bytes alone — unlike the index artifact, which also
+    # keys on chunk geometry — so re-chunking experiments never re-parse.
+    pages_path = os.path.join(INDEX_CACHE_DIR, f"{_pdf_digest()}.pages.jsonl")
+    if os.path.exists(pages_path):
+        with open(pages_path, "rb") as f:
+            return [orjson.loads(line) for line in f.read().splitlines() if line]
+    pages = _read_pdf_pages(path)
+    os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+    with open(pages_path, "wb") as f:
+        f.write(b"\n".join(orjson.dumps(page) for page in pages))
+    return pages
+
+
+# cl100k_base matches the embedding model's tokenizer, so chunk budgets
+# line up with what the API actually bills.
+_ENCODER = tiktoken.get_encoding("cl100k_base")
+
+
+def _chunk_pages(pages, chunk_tokens=CHUNK_TOKENS, overlap=CHUNK_TOKEN_OVERLAP):
+    chunks = []
+    step = chunk_tokens - overlap
+    for page in pages:
+        tokens = _ENCODER.encode(page["text"])
+        starts = list(range(0, len(tokens), step))
+        # A trailing window that pokes only a few tokens past the previous
+        # one would become a tiny, context-poor chunk wasting an embedding
+        # and a retrieval slot; re-anchor it to end at the page boundary so
+        # the final chunk is full-sized instead.
+        if len(starts) > 1 and len(tokens) - starts[-1] < MIN_CHUNK_TOKENS:
+            starts[-1] = max(0, len(tokens) - chunk_tokens)
+            # Pages of chunk_tokens-overlap..chunk_tokens tokens re-anchor
+            # to 0, colliding with the first window; keep one copy so the
+            # page isn't embedded, stored, and retrieved twice.
+            if starts[-1] <= starts[-2]:
+                starts.pop()
+        # Window offsets are precomputed and all windows decode in one
+        # C-side decode_batch call; page text was already stripped by
+        # _clean_text, so no per-piece strip copies.
+        windows = [tokens[start:start + chunk_tokens] for start in starts]
+        for piece in _ENCODER.decode_batch(windows):
+            if piece:
+                chunks.append({
+                    "page": page["page"],
+                    "text": piece,
+                    # Prebuilt once here so the per-question context is a
+                    # pure join with no formatting or slicing on the hot path.
+                    "context_text": f"[Page {page['page']}] {piece}",
+                    # Evidence snippet sliced once at index time instead of
+                    # on every rerender of the sources expander.
+                    "preview": piece if len(piece) <= EVIDENCE_PREVIEW_CHARS
+                    else piece[:EVIDENCE_PREVIEW_CHARS] + "…",
+                })
+    return chunks
+
+
+async def _embed_batches_async(key, batches, on_result):
+    # All batches fly concurrently (bounded by the semaphore), so total
+    # wall time is roughly the slowest batch instead of the sum of all
+    # round-trips. Each response is handed to on_result as it lands and
+    # then dropped, so at most one batch of Python-float vectors is alive
+    # at a time instead of the whole corpus.
+    aclient = AsyncOpenAI(api_key=key)
+    sem = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+    async def _embed_batch(batch_index, batch):
+        async with sem:
+            # Stagger starts slightly so EMBED_CONCURRENCY requests don't
+            # hit the rate limiter in the same instant, and back off with
+            # jitter when they do.
+            await asyncio.sleep(random.uniform(0, 0.1))
+            for attempt in range(EMBED_MAX_RETRIES):
+                try:
+                    resp = await aclient.embeddings.create(
+                        model=EMBED_MODEL, input=batch, dimensions=EMBED_DIMENSIONS
+                    )
+                    on_result(batch_index, [d.embedding for d in resp.data])
+                    return
+                except RateLimitError:
+                    if attempt == EMBED_MAX_RETRIES - 1:
+                        raise
+                    await asyncio.sleep((2 ** attempt) + random.uniform(0, 1))
+
     try:
-        loader = PyPDFLoader(PDF_FILE_PATH)
-        docs = loader.load()
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            separators=["\n\n", "\n", "●", "•", "-", " "]
-        )
-        splits = splitter.split_documents(docs)
-        embeddings = OpenAIEmbeddings(openai_api_key=key)
-        vectorstore = FAISS.from_documents(splits, embeddings)
-        return vectorstore
-    except Exception as e:
-        raise e
+        await asyncio.gather(*(_embed_batch(i, b) for i, b in enumerate(batches)))
+    finally:
+        await aclient.close()
+
+
+def _pack_batches(texts):
+    # Greedy token-budget packing: a fixed item count under-fills requests
+    # with short chunks and can overflow the API's input-token cap with
+    # long ones. Fill each request to the budget instead.
+    batches, current, current_tokens = [], [], 0
+    for text in texts:
+        n_tokens = len(_ENCODER.encode(text))
+        if current and (current_tokens + n_tokens > EMBED_BATCH_TOKEN_BUDGET
+                        or len(current) == EMBED_BATCH_MAX_ITEMS):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += n_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _embed_texts(key, texts):
+    # One contiguous float16 matrix filled in place: half the bytes of
+    # fp32 for storage/scan, and no N-small-arrays-then-vstack churn.
+    # Upcast to fp32 only at the FAISS boundary.
+    # Batches are built length-sorted so each request packs similarly
+    # sized chunks (tighter server-side token counts per batch); results
+    # scatter back into original row order via fancy indexing.
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    sorted_texts = [texts[i] for i in order]
+    batches = _pack_batches(sorted_texts)
+    if not batches:
+        return np.empty((0, 0), dtype=np.float16)
+
+    positions = []
+    row = 0
+    for batch in batches:
+        positions.append(order[row:row + len(batch)])
+        row += len(batch)
+
+    out = None
+
+    def _scatter(batch_index, batch_vecs):
+        nonlocal out
+        arr = np.asarray(batch_vecs, dtype=np.float16)
+        if out is None:
+            out = np.empty((len(texts), arr.shape[1]), dtype=np.float16)
+        out[positions[batch_index]] = arr
+
+    asyncio.run(_embed_batches_async(key, batches, _scatter))
+    return out
+
+
+def _chunk_vector_cache_path():
+    return os.path.join(
+        INDEX_CACHE_DIR, f"chunk-vectors-{EMBED_MODEL}-{EMBED_DIMENSIONS}d.npz"
+    )
+
+
+def _embed_texts_cached(key, texts):
+    """Embed texts, reusing per-chunk vectors cached on disk.
+
+    The cache is keyed by sha256 of the chunk text alone — independent of
+    chunk geometry — so changing CHUNK_SIZE/CHUNK_OVERLAP re-embeds only
+    the chunks whose text actually changed, not the whole PDF. Misses are
+    grouped into one concurrent _embed_texts pass.
+    """
+    path = _chunk_vector_cache_path()
+    cache = {}
+    if os.path.exists(path):
+        with np.load(path) as data:
+            cache = {name: data[name] for name in data.files}
+    hashes = [hashlib.sha256(t.encode()).hexdigest() for t in texts]
+    miss_idx = [i for i, h in enumerate(hashes) if h not in cache]
+    if miss_idx:
+        new_vectors = _embed_texts(key, [texts[i] for i in miss_idx])
+        for i, vec in zip(miss_idx, new_vectors):
+            cache[hashes[i]] = vec
+        os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+        np.savez(path, **cache)
+    return np.stack([cache[h] for h in hashes])
+
+
+def _build_index(vectors):
+    if vectors.dtype != np.float32:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    # In-place NumPy normalize: BLAS/SIMD over the contiguous matrix,
+    # avoiding faiss's scalar fvec_renorm_L2 row loop.
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, np.maximum(norms, 1e-12), out=vectors)
+    dim = vectors.shape[1]
+    # 8-bit scalar quantization: search streams a quarter of the bytes of
+    # fp32 storage, which is the whole cost of a memory-bound scan. Recall
+    # loss is negligible for normalized text embeddings.
+    if len(vectors) > HNSW_THRESHOLD:
+        # Graph search is sub-linear in N, vs. the O(N*d) scan of a flat
+        # index that streams every vector through memory per query.
+        index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M,
+                                  faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    else:
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit,
+                                           faiss.METRIC_INNER_PRODUCT)
+    index.train(vectors)
+    index.add(vectors)
+    return index, vectors
+
+
+def _index_cache_paths():
+    # Key on everything that invalidates the artifact: source bytes,
+    # chunking geometry, and embedding model.
+    digest = hashlib.sha256(_pdf_digest().encode())
+    digest.update(
+        f"{CHUNK_TOKENS}:{CHUNK_TOKEN_OVERLAP}:{EMBED_MODEL}:{EMBED_DIMENSIONS}"
+        f":v{INDEX_SCHEMA_VERSION}".encode()
+    )
+    stem = os.path.join(INDEX_CACHE_DIR, digest.hexdigest())
+    return f"{stem}.faiss", f"{stem}.meta.jsonl", f"{stem}.vectors.npy"
+
+
+def _make_resources(index, chunks, normalized):
+    # Keep the normalized matrix resident only while it is small enough
+    # for the BLAS search path; large corpora rely on the index alone.
+    if normalized is not None and len(chunks) >= NUMPY_SEARCH_MAX:
+        normalized = None
+    return {"index": index, "chunks": chunks, "vectors": normalized}
+
+
+def _load_index_from_disk(index_path, meta_path, vectors_path):
+    if not (os.path.exists(index_path) and os.path.exists(meta_path)):
+        return None
+    try:
+        # mmap pages the index in lazily instead of copying it into RAM
+        # up front; not every index type supports it, hence the fallback.
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP)
+    except RuntimeError:
+        index = faiss.read_index(index_path)
+    # One bulk read + C-level parse per line beats a Python text-mode
+    # loop allocating through json.loads on every cold start.
+    with open(meta_path, "rb") as f:
+        raw = f.read()
+    chunks = [orjson.loads(line) for line in raw.splitlines() if line]
+    normalized = None
+    if os.path.exists(vectors_path) and len(chunks) < NUMPY_SEARCH_MAX:
+        normalized = np.load(vectors_path).astype(np.float32)
+    return _make_resources(index, chunks, normalized)
+
+
+def _save_index_to_disk(index_path, meta_path, vectors_path, index, chunks, normalized):
+    os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+    faiss.write_index(index, index_path)
+    with open(meta_path, "wb") as f:
+        f.write(b"\n".join(orjson.dumps(chunk) for chunk in chunks))
+    np.save(vectors_path, normalized.astype(np.float16))
+
+
+def _build_worker(key, index_path, meta_path, vectors_path, progress_path):
+    # Runs in a child process: the CPU-heavy parse/chunk/index work must
+    # not hold the Streamlit script thread. Results land on disk; progress
+    # is reported through a small status file the parent polls.
+    def report(message):
+        with open(progress_path, "w", encoding="utf-8") as f:
+            f.write(message)
+
+    report("Reading PDF pages...")
+    pages = _read_pdf_pages_cached(PDF_FILE_PATH)
+    report("Chunking pages...")
+    chunks = _chunk_pages(pages)
+    report(f"Embedding {len(chunks)} chunks...")
+    vectors = _embed_texts_cached(key, [c["text"] for c in chunks])
+    report("Building index...")
+    index, normalized = _build_index(vectors)
+    _save_index_to_disk(index_path, meta_path, vectors_path, index, chunks, normalized)
+
+
+@st.cache_resource(show_spinner=False)
+def build_retriever(key):
+    # cache_resource evaporates on container restart; the disk artifact
+    # makes cold starts an O(disk-read) instead of re-embedding the PDF.
+    index_path, meta_path, vectors_path = _index_cache_paths()
+    cached = _load_index_from_disk(index_path, meta_path, vectors_path)
+    if cached is not None:
+        return cached
+    os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+    progress_path = f"{index_path}.progress"
+    status = st.empty()
+    if "fork" in multiprocessing.get_all_start_methods():
+        # _build_worker lives in the Streamlit-executed script module, which
+        # spawn/forkserver children cannot re-import — only fork inherits it.
+        ctx = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as ex:
+            future = ex.submit(_build_worker, key, index_path, meta_path,
+                               vectors_path, progress_path)
+            while True:
+                try:
+                    future.result(timeout=0.5)
+                    break
+                except FuturesTimeout:
+                    if os.path.exists(progress_path):
+                        with open(progress_path, encoding="utf-8") as f:
+                            status.caption(f.read())
+    else:
+        # No fork available (e.g. macOS): build in-process. Progress still
+        # lands in the status file, but only after each stage completes.
+        _build_worker(key, index_path, meta_path, vectors_path, progress_path)
+    status.empty()
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    return _load_index_from_disk(index_path, meta_path, vectors_path)
+
+
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def _embed_query_cached(question, key):
+    # Users re-ask the same questions and Streamlit reruns scripts freely;
+    # a cache hit skips the embedding round-trip entirely. Stored as bytes
+    # because ndarrays are copied on every cache read.
+    resp = get_openai_client(key).embeddings.create(
+        model=EMBED_MODEL, input=[question], dimensions=EMBED_DIMENSIONS
+    )
+    vec = np.asarray([resp.data[0].embedding], dtype=np.float32)
+    # For one row the faiss.normalize_L2 dispatch costs more than the
+    # arithmetic; a fused NumPy in-place divide does the same job.
+    vec /= np.linalg.norm(vec, axis=1, keepdims=True) + 1e-12
+    return vec.tobytes()
+
+
+def _embed_query(question, key):
+    # Zero-copy view over the cached bytes: the row is already normalized
+    # and nothing downstream writes to it (the batcher vstacks a fresh
+    # matrix), so no defensive copy is needed.
+    raw = _embed_query_cached(question, key)
+    return np.frombuffer(raw, dtype=np.float32).reshape(1, -1)
+
+
+def _mmr_select(cand_ids, cand_scores, vectors, k):
+    # Greedy maximal-marginal-relevance over a small candidate pool: the
+    # overlapping chunk windows make near-duplicate hits common, and
+    # redundant context is prompt tokens spent saying the same thing twice.
+    selected = [0]
+    cand_sims = vectors[cand_ids] @ vectors[cand_ids].T
+    while len(selected) < k:
+        remaining = [i for i in range(len(cand_ids)) if i not in selected]
+        redundancy = cand_sims[np.ix_(remaining, selected)].max(axis=1)
+        mmr = MMR_LAMBDA * cand_scores[remaining] - (1 - MMR_LAMBDA) * redundancy
+        selected.append(remaining[int(np.argmax(mmr))])
+    return [cand_ids[i] for i in selected]
+
+
+def _search(resources, qvecs, k=RETRIEVAL_K):
+    """Search a (B, d) block of query vectors; returns per-row chunk lists."""
+    chunks = resources["chunks"]
+    k = min(k, len(chunks))
+    vectors = resources["vectors"]
+    if vectors is not None:
+        # For a few thousand vectors a BLAS matmul + argpartition beats
+        # FAISS's per-call dispatch and result-handler overhead. Fetch a
+        # wider pool than k so the MMR pass has duplicates to discard.
+        fetch = min(max(MMR_FETCH_K, k), len(chunks))
+        scores = qvecs @ vectors.T
+        top = np.argpartition(-scores, fetch - 1, axis=1)[:, :fetch]
+        rows = []
+        for b in range(scores.shape[0]):
+            order = top[b][np.argsort(-scores[b, top[b]])]
+            if fetch > k:
+                order = _mmr_select(order, scores[b, order], vectors, k)
+            rows.append([chunks[i] for i in order])
+        return rows
+    _, ids = resources["index"].search(qvecs, k)
+    return [[chunks[i] for i in row if i != -1] for row in ids]
+
+
+class _SearchBatcher:
+    """Coalesce concurrent single-vector searches into one index.search.
+
+    A flat/graph search streams the same index memory whether it serves
+    one query row or thirty, so concurrent sessions' queries that land
+    within a short window share one scan instead of issuing B of them.
+    """
+
+    WINDOW_S = 0.01
+    MAX_BATCH = 32
+
+    def __init__(self, resources):
+        self._resources = resources
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def search(self, qvec, k=RETRIEVAL_K):
+        future = Future()
+        self._queue.put((qvec, k, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.WINDOW_S
+            while len(batch) < self.MAX_BATCH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            stacked = np.vstack([qvec for qvec, _, _ in batch])
+            k_max = max(k for _, k, _ in batch)
+            try:
+                rows = _search(self._resources, stacked, k_max)
+            except Exception as exc:
+                for _, _, future in batch:
+                    future.set_exception(exc)
+                continue
+            for row, (_, k, future) in zip(rows, batch):
+                future.set_result(row[:k])
+
+
+@st.cache_resource(show_spinner=False)
+def _get_search_batcher(key):
+    return _SearchBatcher(build_retriever(key))
+
+
+async def _retrieve_async(question, key, k=RETRIEVAL_K):
+    # The batcher fetch (cache lookup, or a disk/API index rebuild on cold
+    # start) and the query-embedding HTTP round-trip are independent; run
+    # them concurrently so the query costs max(t_index, t_http), not the sum.
+    batcher_task = asyncio.create_task(asyncio.to_thread(_get_search_batcher, key))
+    qvec = await asyncio.to_thread(_embed_query, question, key)
+    batcher = await batcher_task
+    return await asyncio.to_thread(batcher.search, qvec, k)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_worker_loop():
+    # One long-lived event loop on a daemon thread, shared by all
+    # sessions: retrieval coroutines are submitted to it instead of
+    # paying asyncio.run's loop setup/teardown on every question.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+@st.cache_data(ttl=3600, max_entries=500, show_spinner=False)
+def retrieve(question, key, k=RETRIEVAL_K):
+    # Retrieval is deterministic for a given question, so repeat questions
+    # skip the embed + search entirely, not just the embedding. The hit
+    # rate compounds with _embed_query_cached; ttl/max_entries keep the
+    # pickle store bounded on long-running deployments.
+    future = asyncio.run_coroutine_threadsafe(
+        _retrieve_async(question, key, k), _get_worker_loop()
+    )
+    return future.result()
+
 
 # --- 6. SIDEBAR & LANGUAGE ---
 if "messages" not in st.session_state:
-    st.session_state.messages = []
-
-with st.sidebar:
-    st.image("https://cdn-icons-png.flaticon.com/512/3063/3063176.png", width=50)
-    st.header("App Settings")
-    st.divider()
-
-    st.markdown("### 🌐 Language / ቋንቋ")
-    selected_language = st.selectbox(
-        "Choose response language:",
-        [
-            "English", 
-            "Amharic (አማርኛ)", 
-            "Swahili (Kiswahili)", 
-            "Oromo (Afaan Oromoo)", 
-            "French (Français)", 
-            "Spanish (Español)", 
-            "Arabic (العربية)",
-            "Portuguese (Português)"
-        ],
-        key="language_selector"
-    )
-    st.divider()
-    
-    st.markdown("### 🚦 AWaRe Color Legend")
-    st.markdown(":green[**🟢 First Choice**]")
-    st.markdown(":orange[**🟡 Second Choice**]")
-    st.markdown(":red[**🔴 Reserve**]")
-    st.divider()
-    
-    if st.button("🔄 Start New Consultation", type="primary", use_container_width=True):
-        st.session_state.messages = []
-        st.rerun()
+    # deque(maxlen=...) evicts the oldest turn in O(1) on append, so the
+    # history can never grow without bound across a long consultation.
+    st.session_state.messages = deque(maxlen=MAX_HISTORY_MESSAGES)
+
+selected_language = create_sidebar()
 
 # Load DB
 with st.spinner("Initializing medical knowledge base..."):
     try:
-        vectorstore = load_knowledge_base(api_key)
-        retriever = vectorstore.as_retriever(search_kwargs={"k": 6})
+        build_retriever(api_key)
     except Exception as e:
         st.error(f"Initialization Failed: {e}")
         st.stop()
 
 # --- 7. DYNAMIC PROMPT LOGIC ---
 
-template = """You are PrescribeWise, an expert medical assistant based on the WHO AWaRe Antibiotic Book.
-
-CONTEXT:
-{context}
-
-QUESTION:
-{question}
-
-TARGET LANGUAGE: {language}
+SYSTEM_PROMPT = """You are PrescribeWise, an expert medical assistant based on the WHO AWaRe Antibiotic Book.
 
 INSTRUCTIONS:
-1. {logic_instruction}
+1. Answer ONLY from the CONTEXT supplied with each question, following the STRATEGY given for that turn.
 
 2. **DETAIL LEVEL: HIGH.** - Explicitly list: **Drug Names**, **Exact Dosages** (mg/kg), **Frequency**, and **Duration**.
    - If weight bands (e.g., 3-6kg) are in the context, YOU MUST INCLUDE THEM.
@@ -165,38 +739,157 @@ INSTRUCTIONS:
 4. **CITATION:** Cite [Page X] at the end of sections.
 """
 
-prompt = ChatPromptTemplate.from_template(template)
+TURN_TEMPLATE = """CONTEXT:
+{context}
+
+QUESTION:
+{question}
+
+TARGET LANGUAGE: {language}
 
-# Use GPT-4o. It is ESSENTIAL for Amharic. 
+STRATEGY:
+{logic_instruction}
+"""
+
+# Use GPT-4o. It is ESSENTIAL for Amharic.
 # Temperature 0.2 helps prevent the repetition loop ("dry dry dry...").
-llm = ChatOpenAI(model="gpt-4o", temperature=0.2, openai_api_key=api_key)
+CHAT_MODEL = "gpt-4o"
+
+# Each turn's retrieved context accumulates in the server-side thread, so
+# the effective prompt still grows with conversation length. Restart the
+# chain after this many turns; within a chain, truncation="auto" lets the
+# API drop middle turns instead of erroring at the context limit.
+MAX_CHAIN_TURNS = 12
+
+
+def _make_context(docs):
+    return "\n\n".join(doc["context_text"] for doc in docs)
+
 
-def format_docs(docs):
-    return "\n\n".join(f"[Page {doc.metadata.get('page', '?')}] {doc.page_content}" for doc in docs)
+def stream_response_text(events):
+    """Yield output-text deltas from a Responses API event stream.
+
+    Captures the response id of the completed event in session state so the
+    next turn can thread the conversation server-side.
+    """
+    for event in events:
+        if event.type == "response.output_text.delta":
+            yield event.delta
+        elif event.type == "response.completed":
+            st.session_state.last_response_id = event.response.id
+
+
+def stream_markdown_blocks(events):
+    """Render a streaming answer without re-parsing the whole document.
+
+    Re-rendering the full growing buffer on every delta is O(N^2) in answer
+    length. Blocks completed at blank-line boundaries are written once to
+    their own elements; only the trailing block is re-rendered with the
+    cursor. Returns the full answer text.
+    """
+    done_area = st.container()
+    tail = st.empty()
+    parts = []
+    pending = ""
+    last_paint = 0.0
+    for delta in stream_response_text(events):
+        pending += delta
+        if "\n\n" in pending:
+            done, _, pending = pending.rpartition("\n\n")
+            with done_area:
+                st.markdown(done)
+            parts.append(done + "\n\n")
+        # Deltas arrive far faster than ~60 ms repaints are perceptible;
+        # coalescing them cuts websocket traffic and markdown re-parses
+        # without visibly changing the stream.
+        now = time.monotonic()
+        if now - last_paint >= 0.06:
+            tail.markdown(pending + "▌")
+            last_paint = now
+    tail.markdown(pending)
+    parts.append(pending)
+    return "".join(parts)
 
 # --- 8. CHAT INTERFACE ---
-for msg in st.session_state.messages:
-    avatar = "👤" if msg["role"] == "user" else "🩺"
-    with st.chat_message(msg["role"], avatar=avatar):
-        st.markdown(msg["content"])
+AVATARS = {"user": "👤", "assistant": "🩺"}
+HISTORY_INLINE_LIMIT = 6  # messages rendered inline; older ones collapse
+
 
-if user_input := st.chat_input("Ex: What is the treatment for pneumonia?"):
+def _render_evidence(docs):
+    with st.expander("🔍 View Clinical Evidence (Source Text)"):
+        for i, doc in enumerate(docs):
+            st.markdown(f"**Source {i+1} (Page {doc['page']})**")
+            st.caption(doc["preview"])
+            st.divider()
+
+
+def _render_messages(messages, include_docs=True):
+    for msg in messages:
+        with st.chat_message(msg["role"], avatar=AVATARS.get(msg["role"], "🩺")):
+            st.markdown(msg["content"])
+            # Evidence is suppressed inside the "Earlier messages" expander
+            # because Streamlit forbids nesting expanders.
+            if include_docs and msg.get("docs"):
+                _render_evidence(msg["docs"])
+
+
+@st.fragment
+def render_history():
+    # Fragment-scoped so streaming updates elsewhere don't force Streamlit
+    # to re-emit every past message over the websocket. Only the most
+    # recent messages render inline; long consultations park earlier turns
+    # in a collapsed expander instead of re-parsing them every interaction.
+    messages = list(st.session_state.messages)  # deques don't slice
+    older = messages[:-HISTORY_INLINE_LIMIT]
+    if older:
+        with st.expander(f"📜 Earlier messages ({len(older)})"):
+            _render_messages(older, include_docs=False)
+    _render_messages(messages[-HISTORY_INLINE_LIMIT:])
+
+
+render_history()
+
+
+@st.fragment
+def chat_turn(selected_language):
+    # Fragment-scoped so submitting a question reruns only this block
+    # while the answer streams: header, CSS, sidebar, and the history
+    # fragment are untouched until the turn completes. A fragment rerun
+    # clears this block's previous output, so each finished turn ends
+    # with an app-scope rerun that migrates it into render_history —
+    # otherwise turn N would visibly erase turn N-1.
+    user_input = st.chat_input("Ex: What is the treatment for pneumonia?")
+    if not user_input:
+        return
     st.session_state.messages.append({"role": "user", "content": user_input})
     with st.chat_message("user", avatar="👤"):
         st.markdown(user_input)
 
+    # Health workers re-ask the same dosing questions; an exact repeat in
+    # the same language replays the stored answer with zero API calls.
+    qa_cache = st.session_state.setdefault("qa_cache", OrderedDict())
+    cache_key = (" ".join(user_input.split()).lower(), selected_language)
+
     with st.chat_message("assistant", avatar="🩺"):
+        if (hit := qa_cache.get(cache_key)) is not None:
+            qa_cache.move_to_end(cache_key)
+            cached_answer, cached_docs = hit
+            st.session_state.messages.append(
+                {"role": "assistant", "content": cached_answer, "docs": cached_docs}
+            )
+            st.rerun(scope="app")
+
         with st.spinner(f"Consulting guidelines ({selected_language})..."):
             try:
                 # 1. Retrieve Context
-                relevant_docs = retriever.invoke(user_input)
-                formatted_context = format_docs(relevant_docs)
+                relevant_docs = retrieve(user_input, api_key)
+                formatted_context = _make_context(relevant_docs)
 
                 # 2. Determine Logic based on Language
-                
+
                 # LIST OF LANGUAGES THAT NEED "ENGLISH THOUGHT" FIRST
                 TRANSLATION_MODE_LANGUAGES = ["Amharic (አማርኛ)", "Swahili (Kiswahili)", "Oromo (Afaan Oromoo)"]
-                
+
                 if selected_language in TRANSLATION_MODE_LANGUAGES:
                     # LOGIC FOR AMHARIC/OROMO/SWAHILI
                     # We strictly forbid repetition to fix the "ye dereqe..." loop.
@@ -216,44 +909,60 @@ if user_input := st.chat_input("Ex: What is the treatment for pneumonia?"):
                     2. Do not translate from English; think directly in {language}.
                     """
 
-                # 3. Build Chain
-                rag_chain = (
-                    {
-                        "context": lambda x: formatted_context, 
-                        "question": itemgetter("question"), 
-                        "language": itemgetter("language"),
-                        "logic_instruction": itemgetter("logic_instruction")
-                    }
-                    | prompt 
-                    | llm 
-                    | StrOutputParser()
+                # 3. Build the turn input. History is NOT re-sent: the
+                # Responses API threads conversation state server-side via
+                # previous_response_id, so uplink stays O(latest turn).
+                turn_input = TURN_TEMPLATE.format(
+                    context=formatted_context,
+                    question=user_input,
+                    language=selected_language,
+                    logic_instruction=current_logic.format(language=selected_language),
                 )
-                
+
                 # 4. Stream Response
-                response_container = st.empty()
-                full_response = ""
-                
-                # Create input dictionary
-                input_dict = {
-                    "question": user_input, 
-                    "language": selected_language,
-                    "logic_instruction": current_logic
-                }
-
-                for chunk in rag_chain.stream(input_dict):
-                    full_response += chunk
-                    response_container.markdown(full_response + "▌")
-                
-                response_container.markdown(full_response)
-                
-                # 5. Evidence
-                with st.expander("🔍 View Clinical Evidence (Source Text)"):
-                    for i, doc in enumerate(relevant_docs):
-                        st.markdown(f"**Source {i+1} (Page {doc.metadata.get('page', '?')})**")
-                        st.caption(doc.page_content)
-                        st.divider()
-                
-                st.session_state.messages.append({"role": "assistant", "content": full_response})
-                
+                previous_response_id = st.session_state.get("last_response_id")
+                if st.session_state.get("chain_turns", 0) >= MAX_CHAIN_TURNS:
+                    previous_response_id = None
+                    st.session_state.chain_turns = 0
+
+                stream = client.responses.create(
+                    model=CHAT_MODEL,
+                    instructions=SYSTEM_PROMPT,
+                    input=turn_input,
+                    previous_response_id=previous_response_id,
+                    truncation="auto",
+                    temperature=0.2,
+                    stream=True,
+                )
+                full_response = stream_markdown_blocks(stream)
+                st.session_state.chain_turns = st.session_state.get("chain_turns", 0) + 1
+
+                # Only context-free turns are safe to replay: an answer
+                # conditioned on the response chain (e.g. "what about in
+                # children?") is specific to that consultation and must
+                # not resurface verbatim in a different one.
+                if previous_response_id is None:
+                    qa_cache[cache_key] = (full_response, relevant_docs)
+                    if len(qa_cache) > QA_CACHE_MAX:
+                        qa_cache.popitem(last=False)
+                # Evidence travels with the message so render_history can
+                # show the expander after the turn migrates there.
+                st.session_state.messages.append(
+                    {"role": "assistant", "content": full_response, "docs": relevant_docs}
+                )
+
             except Exception as e:
                 st.error(f"An error occurred: {e}")
+                return
+
+    # Full rerun: the finished turn (and its evidence) re-renders inside
+    # render_history, keeping the whole conversation on screen.
+    st.rerun(scope="app")
+
+
+chat_turn(selected_language)
+
+# Static footer: a prebuilt constant, emitted only once a consultation is
+# underway so empty sessions don't pay for it at all.
+if st.session_state.messages:
+    st.markdown(FOOTER_HTML, unsafe_allow_html=True)